@@ -97,4 +97,7 @@ create table solutions
 create unique index solutions_solution_id_uindex
     on solutions (solution_id);
 
+create index solutions_task_id_index
+    on solutions (task_id);
+
 
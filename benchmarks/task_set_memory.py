@@ -0,0 +1,129 @@
+"""Peak memory of listing tasks with the wide frame and with TaskSet.
+
+Both variants get synthetic query results of the same catalog and prepare
+the frame printed by `list tasks`. Peak memory is measured with
+tracemalloc, which also traces numpy (and so pandas) buffers.
+
+    python benchmarks/task_set_memory.py --sizes 100000 1000000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from task_set import TaskSet  # noqa: E402
+
+SUBJECTS = 20
+TOPICS = 200
+
+
+def make_tex(task_id: int, tex_length: int) -> str:
+    return f"\\int{{x^{{{task_id}}}dx}}".ljust(tex_length, "x")
+
+
+def wide_list_tasks(n_tasks: int, solutions_per_task: int,
+                    tex_length: int, verbose: bool) -> pd.DataFrame:
+    """Builds the wide query result and the printed frame as `list_tasks`
+    did before TaskSet, with one row per solution."""
+    rng = np.random.default_rng(0)
+    task_ids = np.repeat(np.arange(1, n_tasks + 1), solutions_per_task)
+    topic_ids = task_ids % TOPICS
+    difficulty = rng.integers(1, 6, n_tasks)
+    df = pd.DataFrame({
+        "subject_id": topic_ids % SUBJECTS,
+        "subject": [f"subject {topic_id % SUBJECTS}" for topic_id in topic_ids],
+        "topic_id": topic_ids,
+        "topic": [f"topic {topic_id}" for topic_id in topic_ids],
+        "task_id": task_ids,
+        # Every row read from the DB is a separate string
+        "tex": [make_tex(task_id, tex_length) for task_id in task_ids],
+        "difficulty": difficulty[task_ids - 1],
+        "answer": [f"answer {task_id}" for task_id in task_ids],
+        "solution_id": np.arange(1, len(task_ids) + 1),
+        "solution_filetype": [".png"] * len(task_ids),
+    })
+
+    solution_ids_list = df.groupby("task_id").apply(
+        lambda x: x.solution_id.drop_duplicates().tolist())
+    solution_ids_list.name = "solution_ids_list"
+    df = df.merge(solution_ids_list, left_on="task_id", right_index=True,
+                  how="inner", validate="many_to_one")
+    if not verbose:
+        cols = ["subject", "topic", "task_id", "difficulty", "solution_ids_list"]
+        return df.loc[:, cols].drop_duplicates(subset=["subject", "topic", "task_id"])
+    return df.copy()
+
+
+def task_set_list_tasks(n_tasks: int, solutions_per_task: int,
+                        tex_length: int, verbose: bool) -> pd.DataFrame:
+    """Builds the normalized query results, the TaskSet and its printed
+    frame."""
+    rng = np.random.default_rng(0)
+    task_ids = np.arange(1, n_tasks + 1)
+    topic_ids = task_ids % TOPICS
+    links = pd.DataFrame({
+        "subject": [f"subject {topic_id % SUBJECTS}" for topic_id in topic_ids],
+        "topic": [f"topic {topic_id}" for topic_id in topic_ids],
+        "task_id": task_ids,
+    })
+    tasks = pd.DataFrame({
+        "task_id": task_ids,
+        "tex": [make_tex(task_id, tex_length) for task_id in task_ids],
+        "difficulty": rng.integers(1, 6, n_tasks),
+        "answer": [f"answer {task_id}" for task_id in task_ids],
+    })
+    solutions = pd.DataFrame({
+        "task_id": np.repeat(task_ids, solutions_per_task),
+        "solution_id": np.arange(1, n_tasks * solutions_per_task + 1),
+        "solution_filetype": [".png"] * (n_tasks * solutions_per_task),
+    })
+    task_set = TaskSet.from_frames(tasks, links, solutions)
+    del tasks, links, solutions
+    return task_set.to_display_frame(verbose)
+
+
+def measure(func, *args):
+    """Returns peak traced memory in bytes and the running time."""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=[100_000, 1_000_000],
+                        help="numbers of tasks (default=100000 1000000)")
+    parser.add_argument("--solutions", type=int, default=3,
+                        help="solutions per task (default=3)")
+    parser.add_argument("--tex-length", type=int, default=500,
+                        help="length of each TeX string (default=500)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="prepare the verbose listing")
+    parser.add_argument("--no-wide", action="store_true",
+                        help="skip the (slow) wide frame variant")
+    args = parser.parse_args()
+
+    variants = {"task_set": task_set_list_tasks}
+    if not args.no_wide:
+        variants["wide"] = wide_list_tasks
+
+    print(f"{'tasks':>10} {'variant':>10} {'peak MiB':>10} {'seconds':>10}")
+    for size in args.sizes:
+        for name, func in variants.items():
+            peak, elapsed = measure(func, size, args.solutions,
+                                    args.tex_length, args.verbose)
+            print(f"{size:>10} {name:>10} {peak / 2 ** 20:>10.1f} {elapsed:>10.1f}")
@@ -1,5 +1,6 @@
+import json
 import logging
-from typing import Tuple
+from typing import Iterator, Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -7,6 +8,7 @@ import psycopg2
 from psycopg2.extensions import register_adapter, AsIs
 
 from config import config
+from task_set import TaskSet
 import sqlalchemy
 
 
@@ -21,6 +23,10 @@ def adapt_numpy_int64(numpy_int64):
 register_adapter(np.float64, adapt_numpy_float64)
 register_adapter(np.int64, adapt_numpy_int64)
 
+# Advisory lock guarding the solutions directory. It is outside of the
+# int4 range of hashtext(), which is used for the task locks.
+STORE_LOCK_KEY = 2 ** 32
+
 
 def combine_filters(filters: pd.Series) -> Tuple[str, Tuple]:
     query, params = "TRUE ", ()
@@ -38,6 +44,50 @@ def combine_filters(filters: pd.Series) -> Tuple[str, Tuple]:
     return query, params
 
 
+def select_links(filters: pd.Series,
+                 limit: Optional[int] = None,
+                 after_task_id: Optional[int] = None) -> Tuple[str, Tuple]:
+    """Returns the query selecting (subject, topic, task_id) of the tasks
+    that match the filters and have solutions. The tasks can be paginated
+    by `task_id`: only the first `limit` tasks whose ID is greater than
+    `after_task_id` are selected."""
+    filter_query, filter_params = combine_filters(filters)
+    page_query, page_params = filter_query, filter_params
+    if after_task_id is not None:
+        page_query += "AND tt.task_id > %s "
+        page_params += (after_task_id,)
+    page_query += ("AND EXISTS (SELECT 1 FROM solutions sol "
+                   "            WHERE sol.task_id = tt.task_id) ")
+    select_query = ("SELECT DISTINCT s.subject_name as \"subject\", "
+                    "       t.topic_name as \"topic\", "
+                    "       tt.task_id as \"task_id\" ")
+    join_query = ("JOIN topics t on t.topic_id = tt.topic_id "
+                  "JOIN subject_topic st on tt.topic_id = st.topic_id "
+                  "JOIN subjects s on st.subject_id = s.subject_id ")
+    if limit is None:
+        query = (f"{select_query}"
+                 f"FROM topic_task tt "
+                 f"{join_query}"
+                 f"WHERE {page_query}")
+        return query, page_params
+
+    # Select the page of task IDs first, ordered by the indexed task_id, so
+    # the scan can stop after `limit` tasks, then join their links
+    query = (f"{select_query}"
+             f"FROM (SELECT tt.task_id "
+             f"      FROM topic_task tt "
+             f"      {join_query}"
+             f"      WHERE {page_query}"
+             f"      GROUP BY tt.task_id "
+             f"      ORDER BY tt.task_id "
+             f"      LIMIT %s) page "
+             f"JOIN topic_task tt on tt.task_id = page.task_id "
+             f"{join_query}"
+             f"WHERE {filter_query}")
+    params = page_params + (limit,) + filter_params
+    return query, params
+
+
 class TaskShufflerDB:
     """ Makes the communication with the database easier."""
 
@@ -60,6 +110,8 @@ class TaskShufflerDB:
         cur.execute('SELECT version()')
         logging.info(f"PostgreSQL version:\t{cur.fetchone()}")
         cur.close()
+        # Don't leave the connection inside a transaction
+        self.conn.rollback()
 
         if self.conn is not None:
             self.is_connected = True
@@ -78,29 +130,76 @@ class TaskShufflerDB:
             logging.warning(f"self.is_connected set to False (before it was {self.is_connected}).")
             self.is_connected = False
 
+    def commit(self):
+        """Commit the current transaction."""
+        self.conn.commit()
+
+    def rollback(self):
+        """Roll back the current transaction."""
+        self.conn.rollback()
+
+    def lock_store(self):
+        """Takes the exclusive session level lock of the solutions
+        directory, waiting for all running imports to finish."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%(key)s);", {"key": STORE_LOCK_KEY})
+        cur.close()
+
+    def lock_store_shared(self):
+        """Takes the shared transaction level lock of the solutions
+        directory. Imports hold it from staging their files until the
+        commit, so `lock_store` waits for them."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock_shared(%(key)s);",
+                    {"key": STORE_LOCK_KEY})
+        cur.close()
+
+    def unlock_store(self):
+        """Releases the lock taken by `lock_store`."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT pg_advisory_unlock(%(key)s);", {"key": STORE_LOCK_KEY})
+        cur.close()
+        self.conn.commit()
+
     def insert_task(self, task_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
         """Creates task and returns its id. If task isn't new, also deletes
-        previous solutions and returns their old ids."""
+        previous solutions and returns their old ids.
+
+        Nothing is committed here, the caller has to finish the transaction
+        with `commit` or `rollback`. The task is locked with a transaction
+        level advisory lock, so concurrent imports of the same task are
+        serialized, while disjoint tasks are ingested in parallel. A shared
+        lock of the solutions directory is held as well (see `lock_store`)."""
+        # Keep `fsck --prune` away while the solution files are moved
+        self.lock_store_shared()
         cur = self.conn.cursor()
 
-        # Make sure the subject exists
-        upsert_subject_query = ("INSERT INTO public.subjects (subject_name) "
+        # Lock the task until the end of the transaction
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%(task_tex)s));",
+                    {"task_tex": task_df.tex[0]})
+
+        # Make sure the subject exists. DO NOTHING followed by SELECT doesn't
+        # lock the existing row, so imports sharing the subject don't wait
+        # for each other.
+        insert_subject_query = ("INSERT INTO public.subjects (subject_name) "
                                 "VALUES (%(subject_name)s) "
-                                "ON CONFLICT (subject_name) DO UPDATE "
-                                "SET subject_name = excluded.subject_name "
-                                "RETURNING subject_id;")
-        cur.execute(upsert_subject_query,
+                                "ON CONFLICT (subject_name) DO NOTHING;")
+        cur.execute(insert_subject_query,
+                    {"subject_name": task_df.subject[0]})
+        cur.execute("SELECT subject_id FROM public.subjects "
+                    "WHERE subject_name = %(subject_name)s;",
                     {"subject_name": task_df.subject[0]})
         subject_id = cur.fetchone()[0]
 
         # Make sure the topic exists
         insert_topic_query = ("INSERT INTO public.topics (topic_name) "
                               "VALUES (%(topic_name)s) "
-                              "ON CONFLICT (topic_name) DO UPDATE "
-                              "SET topic_name = excluded.topic_name "
-                              "RETURNING topic_id;")
+                              "ON CONFLICT (topic_name) DO NOTHING;")
         cur.execute(insert_topic_query,
                     {"topic_name": task_df.topic[0]})
+        cur.execute("SELECT topic_id FROM public.topics "
+                    "WHERE topic_name = %(topic_name)s;",
+                    {"topic_name": task_df.topic[0]})
         topic_id = cur.fetchone()[0]
 
         # Make sure the topic is connected to the subject
@@ -134,17 +233,14 @@ class TaskShufflerDB:
         cur.execute(upsert_topic_task_query,
                     {"topic_id": topic_id,
                      "task_id": task_id})
-        self.conn.commit()
-        cur.close()
 
         # Delete all solutions of this task, if such exist
         delete_solutions_query = ("DELETE FROM public.solutions "
                                   "WHERE task_id = %(task_id)s "
                                   "RETURNING solution_id, solution_filetype;")
-        deleted_solutions = pd.read_sql_query(delete_solutions_query,
-                                              self.sqlalchemy_engine,
-                                              params={"task_id": task_id})
-        deleted_solutions.columns = ["solution_id", "solution_filetype"]
+        cur.execute(delete_solutions_query, {"task_id": task_id})
+        deleted_solutions = pd.DataFrame(
+            cur.fetchall(), columns=["solution_id", "solution_filetype"])
 
         # Add solution file
         solution_query_inserts, insert_vals = "", ()
@@ -158,10 +254,9 @@ class TaskShufflerDB:
                                  f"(solution_filetype, task_id) VALUES "
                                  f"{solution_query_inserts} "
                                  f"RETURNING solution_id;")
-        solution_ids = pd.read_sql_query(insert_solution_query,
-                                         self.sqlalchemy_engine,
-                                         params=insert_vals)
-        solution_ids.columns = ["solution_id"]
+        cur.execute(insert_solution_query, insert_vals)
+        solution_ids = pd.DataFrame(cur.fetchall(), columns=["solution_id"])
+        cur.close()
 
         logging.debug(f"New task @{task_id=} about {task_df.topic[0]} in the "
                       f"{task_df.subject[0]} subject.")
@@ -178,27 +273,128 @@ class TaskShufflerDB:
         df.columns = ["subject", "topic"]
         return df
 
-    def get_tasks(self, filters: pd.Series) -> pd.DataFrame:
-        filter_query, params = combine_filters(filters)
-        query = (f"SELECT s.subject_id as \"subject_id\", "
-                 f"       s.subject_name as \"subject\", "
-                 f"       t.topic_id as \"topic_id\", "
-                 f"       t.topic_name as \"topic\", "
-                 f"       tsk.task_id as \"task_id\", "
-                 f"       tsk.task_tex as \"tex\", "
+    def get_tasks(self, filters: pd.Series,
+                  limit: Optional[int] = None,
+                  after_task_id: Optional[int] = None) -> TaskSet:
+        """Returns the tasks matching the filters as a compact TaskSet.
+        Links, tasks and solutions are fetched with separate queries in one
+        REPEATABLE READ transaction, so TeX is transferred once per task
+        instead of once per solution."""
+        links_query, params = select_links(filters, limit, after_task_id)
+        tasks_query = ("SELECT tsk.task_id as \"task_id\", "
+                       "       tsk.task_tex as \"tex\", "
+                       "       tsk.difficulty as \"difficulty\", "
+                       "       tsk.answer as \"answer\" "
+                       "FROM tasks tsk "
+                       "WHERE tsk.task_id IN (SELECT task_id FROM tasher_links);")
+        solutions_query = ("SELECT sol.task_id as \"task_id\", "
+                           "       sol.solution_id as \"solution_id\", "
+                           "       sol.solution_filetype as \"solution_filetype\" "
+                           "FROM solutions sol "
+                           "WHERE sol.task_id IN (SELECT task_id FROM tasher_links);")
+        # The isolation level can only be set before the first query of
+        # a transaction, listing never has pending changes to lose
+        self.conn.rollback()
+        cur = self.conn.cursor()
+        try:
+            # Run all queries on one snapshot, so concurrent imports can't
+            # make them disagree
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+            # Evaluate the filters only once
+            cur.execute(f"CREATE TEMPORARY TABLE tasher_links ON COMMIT DROP "
+                        f"AS {links_query};", params)
+            cur.execute("SELECT subject, topic, task_id FROM tasher_links;")
+            links = pd.DataFrame(cur.fetchall(),
+                                 columns=["subject", "topic", "task_id"])
+            cur.execute(tasks_query)
+            tasks = pd.DataFrame(cur.fetchall(),
+                                 columns=["task_id", "tex", "difficulty", "answer"])
+            cur.execute(solutions_query)
+            solutions = pd.DataFrame(cur.fetchall(),
+                                     columns=["task_id", "solution_id", "solution_filetype"])
+        finally:
+            cur.close()
+            # Also drops the temporary table
+            self.conn.rollback()
+        return TaskSet.from_frames(tasks, links, solutions)
+
+    def count_tasks(self, filters: pd.Series) -> int:
+        """Returns the planner's estimate of the number of tasks matching
+        the filters. No rows are read, so it is fast but approximate."""
+        links_query, params = select_links(filters)
+        cur = self.conn.cursor()
+        cur.execute(f"EXPLAIN (FORMAT JSON) "
+                    f"SELECT DISTINCT l.task_id FROM ({links_query}) l;",
+                    params)
+        plan = cur.fetchone()[0]
+        cur.close()
+        self.conn.rollback()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def iter_tasks(self, filters: pd.Series,
+                   limit: Optional[int] = None,
+                   after_task_id: Optional[int] = None,
+                   chunk_size: int = 10000) -> Iterator[pd.DataFrame]:
+        """Yields the tasks matching the filters ordered by `task_id` in
+        chunks of at most `chunk_size` rows. Rows are read from a
+        server-side cursor, so the whole result is never held in memory.
+        There is one row per (subject, topic, task), solution IDs of each
+        task are aggregated into a list. At least one (possibly empty)
+        chunk is always yielded."""
+        links_query, params = select_links(filters, limit, after_task_id)
+        query = (f"WITH l AS ({links_query}) "
+                 f"SELECT l.task_id as \"task_id\", "
+                 f"       l.subject as \"subject\", "
+                 f"       l.topic as \"topic\", "
                  f"       tsk.difficulty as \"difficulty\", "
                  f"       tsk.answer as \"answer\", "
-                 f"       sol.solution_id as \"solution_id\", "
-                 f"       sol.solution_filetype as \"solution_filetype\" "
-                 f"FROM tasks tsk "
-                 f"JOIN solutions sol on tsk.task_id = sol.task_id "
-                 f"JOIN topic_task tt on tsk.task_id = tt.task_id "
-                 f"JOIN topics t on t.topic_id = tt.topic_id "
-                 f"JOIN subject_topic st on tt.topic_id = st.topic_id "
-                 f"JOIN subjects s on st.subject_id = s.subject_id "
-                 f"WHERE {filter_query};")
-        df = pd.read_sql_query(query, self.sqlalchemy_engine, params=params)
-        return df
+                 f"       tsk.task_tex as \"tex\", "
+                 f"       sol.solution_ids as \"solution_ids\" "
+                 f"FROM l "
+                 f"JOIN tasks tsk on tsk.task_id = l.task_id "
+                 f"JOIN (SELECT sol.task_id, "
+                 f"             array_agg(sol.solution_id "
+                 f"                       ORDER BY sol.solution_id) as solution_ids "
+                 f"      FROM solutions sol "
+                 f"      WHERE sol.task_id IN (SELECT task_id FROM l) "
+                 f"      GROUP BY sol.task_id) sol on sol.task_id = l.task_id "
+                 f"ORDER BY l.task_id, l.subject, l.topic;")
+        columns = ["task_id", "subject", "topic", "difficulty",
+                   "answer", "tex", "solution_ids"]
+
+        cur = self.conn.cursor(name="tasher_iter_tasks")
+        cur.itersize = chunk_size
+        try:
+            cur.execute(query, params)
+            rows = cur.fetchmany(chunk_size)
+            yield pd.DataFrame(rows, columns=columns)
+            while len(rows) == chunk_size:
+                rows = cur.fetchmany(chunk_size)
+                if rows:
+                    yield pd.DataFrame(rows, columns=columns)
+        finally:
+            cur.close()
+            # Named cursors live inside a transaction, end it
+            self.conn.rollback()
+
+    def iter_solutions(self, chunk_size: int = 10000) -> Iterator[pd.DataFrame]:
+        """Yields all solution IDs and filetypes in chunks of at most
+        `chunk_size` rows read from a server-side cursor."""
+        cur = self.conn.cursor(name="tasher_iter_solutions")
+        cur.itersize = chunk_size
+        try:
+            cur.execute("SELECT solution_id, solution_filetype "
+                        "FROM public.solutions;")
+            rows = cur.fetchmany(chunk_size)
+            while rows:
+                yield pd.DataFrame(rows, columns=["solution_id", "solution_filetype"])
+                rows = cur.fetchmany(chunk_size)
+        finally:
+            cur.close()
+            # Named cursors live inside a transaction, end it
+            self.conn.rollback()
 
 
 if __name__ == "__main__":
@@ -6,6 +6,42 @@ from tasks import Dispatcher
 from db import TaskShufflerDB
 from logging_setup import initialize_logging
 
+
+def positive_int(value: str) -> int:
+    """Argparse type accepting only integers greater than zero."""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def check_tasks_args(parser: argparse.ArgumentParser,
+                     args: argparse.Namespace) -> None:
+    """Rejects `list tasks` options which would be silently ignored."""
+    given = {
+        "--limit": args.limit is not None,
+        "--after": args.after_task_id is not None,
+        "--format": args.output_format != "table",
+        "--output-file": args.output_file is not None,
+        "--sep": args.csv_sep is not None,
+        "--output-dir": args.output_dir is not None,
+        "--verbose": args.verbose > 0,
+        "--group-by": args.group_by != "none",
+    }
+    if args.count:
+        ignored = [option for option, is_given in given.items() if is_given]
+    elif args.output_format == "table":
+        ignored = [option for option in ["--output-file", "--sep"] if given[option]]
+    else:
+        ignored = [option for option in ["--output-dir", "--verbose", "--group-by"]
+                   if given[option]]
+        if args.output_format != "csv" and given["--sep"]:
+            ignored.append("--sep")
+    if ignored:
+        mode = "--count" if args.count else f"--format {args.output_format}"
+        parser.error(f"{', '.join(ignored)} can't be used with {mode}")
+
+
 if __name__ == '__main__':
     initialize_logging()
 
@@ -83,13 +119,70 @@ if __name__ == '__main__':
     )
     tasks_parser.add_argument(
         "--sep",
-        help="separator used in the CSV file (default=;)",
+        help="separator used in the CSV file, only with --format csv (default=;)",
         dest="csv_sep",
-        default=';',
         type=str
     )
+    tasks_parser.add_argument(
+        "-l", "--limit",
+        help="list at most N tasks",
+        metavar="N",
+        type=positive_int
+    )
+    tasks_parser.add_argument(
+        "--after",
+        help="list only tasks whose ID is greater than TASK_ID",
+        dest="after_task_id",
+        metavar="TASK_ID",
+        type=positive_int
+    )
+    tasks_parser.add_argument(
+        "-c", "--count",
+        help="print the approximate number of matching tasks, "
+             "only with the filters",
+        action="store_true"
+    )
+    tasks_parser.add_argument(
+        "-f", "--format",
+        help="output format, other than table are streamed (default=table)",
+        dest="output_format",
+        default="table",
+        choices=["table", "csv", "jsonl", "parquet"],
+        metavar="FORMAT"
+    )
+    tasks_parser.add_argument(
+        "--output-file",
+        help="file to export tasks to, not with --format table "
+             "(default=standard output)",
+        dest="output_file",
+        metavar="FILE",
+        type=str
+    )
+
+    fsck_parser = command_subparsers.add_parser(
+        "fsck", help="check solution files against the database")
+    fsck_parser.add_argument(
+        "--repair",
+        help="move misplaced solution files (e.g. from the old flat "
+             "layout) to their directories",
+        action="store_true"
+    )
+    fsck_parser.add_argument(
+        "--prune",
+        help="delete orphaned solution files and files left in the staging "
+             "directory by interrupted imports (older than an hour)",
+        action="store_true"
+    )
+    fsck_parser.add_argument(
+        "-j", "--workers",
+        help="number of parallel workers checking the files (default=16)",
+        default=16,
+        type=positive_int
+    )
 
     args = main_parser.parse_args()
+    if args.cmd == "list" and args.what_to_list == "tasks":
+        check_tasks_args(tasks_parser, args)
 
     db = TaskShufflerDB()
     db.connect()
@@ -108,11 +201,21 @@ if __name__ == '__main__':
             dp.list_subjects(filters)
         elif args.what_to_list == "topics":
             dp.list_topics(filters, args.group_by)
+        elif args.what_to_list == "tasks" and args.count:
+            dp.count_tasks(filters)
         elif args.what_to_list == "tasks":
             dp.list_tasks(filters,
                           args.group_by,
                           args.output_dir,
-                          args.csv_sep,
-                          args.verbose)
+                          args.csv_sep or ";",
+                          args.verbose,
+                          args.limit,
+                          args.after_task_id,
+                          args.output_format,
+                          args.output_file)
+    elif args.cmd == "fsck":
+        dp.fsck(repair=args.repair,
+                prune=args.prune,
+                workers=args.workers)
 
     db.disconnect()
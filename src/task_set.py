@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+
+class TaskSet:
+    """Compact result of the tasks query.
+
+    Instead of one wide frame with a row per subject, topic, task and
+    solution, the result is kept in normalized parts joined by task IDs:
+
+        tasks:
+            One row per task, indexed by sorted `task_id`, with the `tex`,
+            `difficulty` and `answer` columns. TeX is stored once per task.
+        links:
+            One row per (subject, topic, task) with categorical `subject`
+            and `topic` columns and an integer `task_id` column.
+        solution_offsets, solution_ids:
+            Flat array with the solution IDs of all tasks. Solutions of
+            the i-th task are stored between `solution_offsets[i]` and
+            `solution_offsets[i + 1]`.
+    """
+
+    def __init__(self,
+                 tasks: pd.DataFrame,
+                 links: pd.DataFrame,
+                 solution_offsets: np.ndarray,
+                 solution_ids: np.ndarray):
+        self.tasks = tasks
+        self.links = links
+        self.solution_offsets = solution_offsets
+        self.solution_ids = solution_ids
+
+    @classmethod
+    def from_frames(cls,
+                    tasks: pd.DataFrame,
+                    links: pd.DataFrame,
+                    solutions: pd.DataFrame) -> "TaskSet":
+        """Builds the task set from the query results.
+
+        Parameters
+        ----------
+            tasks:
+                Frame with `task_id`, `tex`, `difficulty` and `answer`.
+            links:
+                Frame with `subject`, `topic` and `task_id`.
+            solutions:
+                Frame with `task_id`, `solution_id` and `solution_filetype`.
+        """
+        # The queries may see different data, keep only the linked tasks
+        tasks = tasks.loc[tasks.task_id.isin(links.task_id)]
+        tasks = tasks.sort_values("task_id").set_index("task_id")
+        task_ids = tasks.index.to_numpy(dtype=np.int64)
+
+        links = links.loc[links.task_id.isin(task_ids)].astype({
+            "subject": "category",
+            "topic": "category",
+            "task_id": np.min_scalar_type(task_ids.max(initial=0)),
+        }).reset_index(drop=True)
+
+        solutions = solutions.loc[solutions.task_id.isin(task_ids)].sort_values(
+            ["task_id", "solution_id"])
+        solution_offsets = np.searchsorted(
+            solutions.task_id.to_numpy(),
+            np.append(task_ids, np.iinfo(np.int64).max)
+        ).astype(np.int64)
+        solution_ids = solutions.solution_id.to_numpy(dtype=np.int64)
+        solution_ids = solution_ids.astype(
+            np.min_scalar_type(solution_ids.max(initial=0)))
+
+        return cls(tasks, links, solution_offsets, solution_ids)
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+    def format_solution_ids(self, sep: str = ", ") -> np.ndarray:
+        """Returns the solution IDs of each task joined into a string."""
+        ids = self.solution_ids.astype(str).tolist()
+        formatted = np.empty(len(self), dtype=object)
+        for i, (start, end) in enumerate(zip(self.solution_offsets[:-1].tolist(),
+                                             self.solution_offsets[1:].tolist())):
+            formatted[i] = sep.join(ids[start:end])
+        return formatted
+
+    def to_display_frame(self, verbose: int = 0) -> pd.DataFrame:
+        """Returns one row per (subject, topic, task) for printing. Task
+        details are looked up by position, TeX and answers are added only
+        in the verbose mode. Solution IDs are formatted once per task and
+        TeX is stored as categorical codes, so neither is copied per row."""
+        positions = self.tasks.index.get_indexer(self.links.task_id)
+        df = self.links.copy()
+        df["difficulty"] = self.tasks.difficulty.to_numpy()[positions]
+        if verbose:
+            df["answer"] = self.tasks.answer.to_numpy()[positions]
+            tex = self.tasks.tex
+            if tex.is_unique:
+                df["tex"] = pd.Categorical.from_codes(positions, categories=tex)
+            else:
+                df["tex"] = tex.to_numpy()[positions]
+        df["solution_ids"] = self.format_solution_ids()[positions]
+        return df
@@ -3,7 +3,10 @@ import sys
 import logging
 import shutil
 import subprocess
-from typing import List
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
 
 import pandas as pd
@@ -13,6 +16,16 @@ from config import config
 
 # TODO: separate python file with constants
 SUPPORTED_FILETYPES = [".png", ".jpg", ".jpeg"]
+EXPORT_FORMATS = ["csv", "jsonl", "parquet"]
+# Leading bytes of valid solution files
+FILETYPE_SIGNATURES = {
+    ".png": b"\x89PNG\r\n\x1a\n",
+    ".jpg": b"\xff\xd8\xff",
+    ".jpeg": b"\xff\xd8\xff",
+}
+SHARDS_NUMBER = 256
+# Staged files older than that (in seconds) are left by interrupted runs
+STALE_STAGING_AGE = 60 * 60
 
 
 def clean_path(path: str, trailing_slash: bool = False) -> str:
@@ -30,17 +43,82 @@ def clean_path(path: str, trailing_slash: bool = False) -> str:
         raise OSError("This operation system is not supported yet.")
 
 
-def make_solution_ids_list(df: pd.DataFrame) -> pd.DataFrame:
-    """Generates the list of solution IDs for each task."""
-    solution_ids_list = df.groupby("task_id").apply(
-        lambda x: x.solution_id.drop_duplicates().tolist())
-    solution_ids_list.name = "solution_ids_list"
-    df = df.merge(solution_ids_list,
-                  left_on="task_id",
-                  right_index=True,
-                  how="inner",
-                  validate="many_to_one")
-    return df
+def get_shard_name(solution_id: int) -> str:
+    """Returns the name of the solutions subdirectory for the solution."""
+    return f"{solution_id % SHARDS_NUMBER:02x}"
+
+
+def scan_dir(path: str) -> List[Tuple[str, str]]:
+    """Returns names and paths of all files in the directory."""
+    with os.scandir(path) as entries:
+        return [(entry.name, entry.path) for entry in entries if entry.is_file()]
+
+
+def is_corrupt(path: str, solution_filetype: str) -> bool:
+    """Checks that the file starts with the signature of its filetype."""
+    signature = FILETYPE_SIGNATURES.get(solution_filetype.lower(), b"")
+    try:
+        with open(path, "rb") as file:
+            header = file.read(max(len(signature), 1))
+    except OSError:
+        return True
+    return len(header) == 0 or not header.startswith(signature)
+
+
+def remove_file(path: str) -> bool:
+    """Removes the file and returns True, or returns False if it doesn't
+    exist (e.g. it was removed by a concurrent run)."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def write_text_chunks(chunks: Iterator[pd.DataFrame], file,
+                      output_format: str, csv_sep: str = ";") -> Optional[int]:
+    """Writes chunks to the CSV or JSON Lines file and returns the last
+    written task ID. In CSV solution IDs are separated by spaces."""
+    last_task_id = None
+    for ind, chunk in enumerate(chunks):
+        if output_format == "csv":
+            chunk = chunk.assign(solution_ids=chunk.solution_ids.map(
+                lambda ids: " ".join(map(str, ids))))
+            chunk.to_csv(file, sep=csv_sep, header=ind == 0, index=False)
+        elif chunk.size > 0:
+            lines = chunk.to_json(orient="records", lines=True, force_ascii=False)
+            file.write(lines if lines.endswith("\n") else f"{lines}\n")
+        if chunk.size > 0:
+            last_task_id = chunk.task_id.iloc[-1]
+    return last_task_id
+
+
+def write_parquet(chunks: Iterator[pd.DataFrame], path: str) -> Optional[int]:
+    """Writes chunks as row groups of the Parquet file and returns the last
+    written task ID."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet export requires the pyarrow package.")
+
+    schema = pa.schema([
+        ("task_id", pa.int64()),
+        ("subject", pa.string()),
+        ("topic", pa.string()),
+        ("difficulty", pa.int64()),
+        ("answer", pa.string()),
+        ("tex", pa.string()),
+        ("solution_ids", pa.list_(pa.int64())),
+    ])
+    last_task_id = None
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_pandas(
+                chunk, schema=schema, preserve_index=False))
+            if chunk.size > 0:
+                last_task_id = chunk.task_id.iloc[-1]
+    return last_task_id
 
 
 class Dispatcher:
@@ -61,11 +139,14 @@ class Dispatcher:
         self.params = config("tasher")
         self.private_dir = clean_path(os.path.join(self.params["directory"], ".tasher/"))
         self.solutions_dir = clean_path(os.path.join(self.private_dir, "solutions/"))
+        self.staging_dir = clean_path(os.path.join(self.private_dir, "staging/"))
         self.solution_prefix = self.params['solution_prefix']
         if not os.path.exists(self.private_dir):
             os.makedirs(self.private_dir)
         if not os.path.exists(self.solutions_dir):
             os.makedirs(self.solutions_dir)
+        if not os.path.exists(self.staging_dir):
+            os.makedirs(self.staging_dir)
 
     def get_sol_filename(self,
                          solution_id: int,
@@ -76,12 +157,34 @@ class Dispatcher:
     def get_sol_path(self,
                      solution_id: int,
                      solution_filetype: str) -> str:
-        """Returns full or relative path to the solution."""
+        """Returns full or relative path to the solution. Solutions are
+        spread over `SHARDS_NUMBER` subdirectories by their IDs."""
         return os.path.join(
             self.solutions_dir,
+            get_shard_name(solution_id),
             self.get_sol_filename(solution_id, solution_filetype)
         )
 
+    def get_legacy_sol_path(self,
+                            solution_id: int,
+                            solution_filetype: str) -> str:
+        """Returns path to the solution in the old flat layout."""
+        return os.path.join(
+            self.solutions_dir,
+            self.get_sol_filename(solution_id, solution_filetype)
+        )
+
+    def stage_file(self, path: str) -> str:
+        """Copies the file into the staging directory under a unique name
+        and returns the path of the copy. The staging directory lives next
+        to the solutions directory, so the copy can later be moved into
+        place with an atomic rename."""
+        fd, staged_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1],
+                                           dir=self.staging_dir)
+        os.close(fd)
+        shutil.copy(path, staged_path)
+        return staged_path
+
     def add_tasks(self, path: str, details_csv: str, sep: str) -> None:
         path = clean_path(path)
         if os.path.isdir(path):
@@ -135,27 +238,201 @@ class Dispatcher:
         df.groupby("solution_name").apply(self.task_to_db)
 
     def task_to_db(self, task_df: pd.DataFrame) -> None:
-        """Adds a new task with all of its solutions to the DB."""
+        """Adds a new task with all of its solutions to the DB.
+
+        Solution files are copied into the staging directory first and
+        renamed into the solutions directory only after the DB changes
+        succeeded, right before the commit. If anything fails, the
+        transaction is rolled back and the new files are removed. If the
+        commit itself fails, the files are kept, because the server may have
+        committed anyway. Files of the replaced solutions are deleted only
+        after the commit."""
         task_df.reset_index(inplace=True)
-        solution_ids, deleted_solutions = self.db.insert_task(task_df)
-
-        # Copy files to private directory and rename them accordingly
-        for row_id, sol in solution_ids.iterrows():
-            new_solution_path = self.get_sol_path(
-                sol.solution_id,
-                task_df.solution_filetype[row_id])
-            shutil.copy(task_df.solution_path[row_id], new_solution_path)
+        staged_paths, new_paths = [], []
+        try:
+            # Protect the staged files from `fsck --prune` until the commit
+            self.db.lock_store_shared()
+            for solution_path in task_df.solution_path:
+                staged_paths.append(self.stage_file(solution_path))
+
+            solution_ids, deleted_solutions = self.db.insert_task(task_df)
+
+            # Move staged files into the private directory and rename them accordingly
+            for row_id, sol in solution_ids.iterrows():
+                new_solution_path = self.get_sol_path(
+                    sol.solution_id,
+                    task_df.solution_filetype[row_id])
+                os.makedirs(os.path.dirname(new_solution_path), exist_ok=True)
+                os.replace(staged_paths[row_id], new_solution_path)
+                new_paths.append(new_solution_path)
+        except BaseException:
+            try:
+                self.db.rollback()
+            finally:
+                for path in staged_paths + new_paths:
+                    remove_file(path)
+            raise
+
+        try:
+            self.db.commit()
+        except BaseException:
+            logging.error(f"Commit failed, the task may be committed anyway. "
+                          f"Kept solution files: {new_paths}. "
+                          f"Run `fsck` to find orphaned files.")
+            raise
         logging.debug(f"Inserted solutions:\n {solution_ids}")
 
         # Delete old solutions from private directory
         for row_id, deleted_sol in deleted_solutions.iterrows():
-            os.remove(self.get_sol_path(
-                solution_id=deleted_sol.solution_id,
-                solution_filetype=deleted_sol.solution_filetype
-            ))
+            paths = [self.get_sol_path(deleted_sol.solution_id,
+                                       deleted_sol.solution_filetype),
+                     self.get_legacy_sol_path(deleted_sol.solution_id,
+                                              deleted_sol.solution_filetype)]
+            # `fsck --prune` may remove the same files concurrently
+            removed = [remove_file(path) for path in paths]
+            if not any(removed):
+                logging.warning(f"File of the deleted solution "
+                                f"{deleted_sol.solution_id} doesn't exist.")
         if deleted_solutions.size > 0:
             logging.info(f"Deleted solutions:\n {deleted_solutions}")
 
+    def fsck(self, repair: bool = False, prune: bool = False,
+             workers: int = 16) -> pd.DataFrame:
+        """Checks that every solution in the DB has its file and that the
+        solutions directory has no other files. Prints and returns the
+        report of the problems found.
+
+        Parameters
+        ----------
+            repair:
+                Move misplaced solution files (e.g. from the old flat
+                layout or a wrong shard) to their expected paths.
+            prune:
+                Delete orphaned solution files and staged files left by
+                interrupted imports. Running imports hold the shared
+                store lock from staging until the commit, so their files
+                are never pruned; staged files younger than
+                `STALE_STAGING_AGE` are kept in any case.
+            workers:
+                Number of threads listing directories and checking files.
+        """
+        if repair or prune:
+            # Wait for the running imports and block the new ones
+            self.db.lock_store()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                report = self._check_store(executor, workers)
+            self._fix_store(report, repair, prune)
+        finally:
+            if repair or prune:
+                self.db.unlock_store()
+
+        if report.size > 0:
+            print(report)
+            print(report.problem.value_counts())
+        else:
+            print("No problems found.")
+        return report
+
+    def _check_store(self, executor: ThreadPoolExecutor,
+                     workers: int) -> pd.DataFrame:
+        """Returns the frame with one row per problem found. At most
+        2 * `workers` chunks of solutions are checked at the same time, so
+        the solutions table is streamed, not loaded at once."""
+        shard_dirs = [self.solutions_dir]
+        with os.scandir(self.solutions_dir) as entries:
+            shard_dirs += [entry.path for entry in entries if entry.is_dir()]
+        found: Dict[str, List[str]] = {}
+        for files in executor.map(scan_dir, shard_dirs):
+            for name, path in files:
+                found.setdefault(name, []).append(path)
+
+        def check_chunk(chunk: pd.DataFrame) -> Tuple[list, set]:
+            problems, names = [], set()
+            for sol in chunk.itertuples(index=False):
+                expected_path = self.get_sol_path(sol.solution_id, sol.solution_filetype)
+                name = os.path.basename(expected_path)
+                names.add(name)
+                # Prefer the expected path, then the first copy which isn't corrupt
+                paths = sorted(found.get(name, []), key=lambda path: path != expected_path)
+                if not paths:
+                    problems.append(("missing", sol.solution_id,
+                                     None, expected_path))
+                    continue
+                kept_path, kept_corrupt = paths[0], True
+                for path in paths:
+                    if not is_corrupt(path, sol.solution_filetype):
+                        kept_path, kept_corrupt = path, False
+                        break
+
+                if kept_corrupt:
+                    problems.append(("corrupt", sol.solution_id,
+                                     kept_path, expected_path))
+                elif kept_path != expected_path:
+                    problems.append(("misplaced", sol.solution_id,
+                                     kept_path, expected_path))
+                for path in paths:
+                    if path == kept_path:
+                        continue
+                    if path == expected_path:
+                        # Corrupt file replaced by the valid copy on repair
+                        problems.append(("corrupt", sol.solution_id,
+                                         path, expected_path))
+                    else:
+                        # Other copies, e.g. leftovers of the flat layout
+                        problems.append(("orphaned", sol.solution_id, path, None))
+            return problems, names
+
+        problems, referenced = [], set()
+
+        def collect(done) -> None:
+            for future in done:
+                chunk_problems, chunk_names = future.result()
+                problems.extend(chunk_problems)
+                referenced.update(chunk_names)
+
+        pending = set()
+        for chunk in self.db.iter_solutions():
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(check_chunk, chunk))
+        collect(wait(pending).done)
+
+        problems += [("orphaned", None, path, None)
+                     for name, paths in found.items() if name not in referenced
+                     for path in paths]
+
+        now = time.time()
+        for _, path in scan_dir(self.staging_dir):
+            try:
+                age = now - os.path.getmtime(path)
+            except FileNotFoundError:
+                # Moved into place by a running import
+                continue
+            if age > STALE_STAGING_AGE:
+                problems.append(("staged", None, path, None))
+
+        report = pd.DataFrame(problems, columns=["problem", "solution_id",
+                                                 "path", "expected_path"])
+        return report.astype({"solution_id": "Int64"})
+
+    def _fix_store(self, report: pd.DataFrame, repair: bool, prune: bool) -> None:
+        """Moves misplaced files and deletes orphaned and staged files."""
+        for problem in report.itertuples(index=False):
+            # Concurrent imports may remove replaced files, skip them
+            if repair and problem.problem == "misplaced":
+                os.makedirs(os.path.dirname(problem.expected_path), exist_ok=True)
+                try:
+                    os.replace(problem.path, problem.expected_path)
+                except FileNotFoundError:
+                    logging.warning(f"{problem.path} doesn't exist anymore.")
+                else:
+                    logging.info(f"Moved {problem.path} to {problem.expected_path}")
+            elif prune and problem.problem in ["orphaned", "staged"]:
+                if remove_file(problem.path):
+                    logging.info(f"Deleted {problem.path}")
+
     def get_task_details(self, df: pd.DataFrame) -> pd.DataFrame:
         """Ask user for details about each file in the df."""
         df.loc[:, "subject"] = input("\nWhat subject are these tasks for? ")
@@ -204,31 +481,60 @@ class Dispatcher:
     def list_tasks(self, filters: pd.Series,
                    group_by: str, output_dir: str,
                    csv_sep: str = ";",
-                   verbose: int = 0) -> None:
-        df = self.db.get_tasks(filters)
-
-        # Generate the list of solution IDs
-        df = make_solution_ids_list(df)
+                   verbose: int = 0,
+                   limit: Optional[int] = None,
+                   after_task_id: Optional[int] = None,
+                   output_format: str = "table",
+                   output_file: Optional[str] = None) -> None:
+        if output_format in EXPORT_FORMATS:
+            self.export_tasks(filters, output_format, output_file,
+                              csv_sep, limit, after_task_id)
+            return
+
+        task_set = self.db.get_tasks(filters, limit, after_task_id)
 
         # Display the result of the query
-        if not verbose:
-            cols = ["subject", "topic", "task_id", "difficulty", "solution_ids_list"]
-            df_to_print = df.loc[:, cols].drop_duplicates(
-                subset=["subject", "topic", "task_id"])
-        else:
+        if verbose:
             pd.options.display.max_columns = 20
-            df_to_print = df.copy()
+        df_to_print = task_set.to_display_frame(verbose)
         if group_by == "none":
             print(df_to_print)
         else:
-            df_to_print.groupby(group_by).apply(print)
+            df_to_print.groupby(group_by, observed=True).apply(print)
 
         # If pdf directory is given generate all files
-        if output_dir is not None and os.path.isdir(output_dir) and df.size > 0:
-            self.generate_latex_document([df], output_dir)
+        if output_dir is not None and os.path.isdir(output_dir) and len(task_set) > 0:
+            self.generate_latex_document([task_set.tasks], output_dir)
         elif output_dir is not None and not os.path.isdir(output_dir):
             raise ValueError("Given path is not a directory")
 
+    def count_tasks(self, filters: pd.Series) -> None:
+        print(self.db.count_tasks(filters))
+
+    def export_tasks(self, filters: pd.Series,
+                     output_format: str,
+                     output_file: Optional[str] = None,
+                     csv_sep: str = ";",
+                     limit: Optional[int] = None,
+                     after_task_id: Optional[int] = None) -> None:
+        """Streams the tasks chunk by chunk to a CSV, JSON Lines or Parquet
+        file. CSV and JSON Lines are written to the standard output if no
+        file (or "-") is given."""
+        chunks = self.db.iter_tasks(filters, limit, after_task_id)
+        if output_format == "parquet":
+            if output_file is None or output_file == "-":
+                raise ValueError("Parquet export requires an output file.")
+            last_task_id = write_parquet(chunks, output_file)
+        elif output_file is None or output_file == "-":
+            last_task_id = write_text_chunks(chunks, sys.stdout, output_format, csv_sep)
+        else:
+            with open(output_file, "w", encoding="utf-8", newline="") as file:
+                last_task_id = write_text_chunks(chunks, file, output_format, csv_sep)
+
+        if last_task_id is not None:
+            logging.info(f"Last exported task_id is {last_task_id}, "
+                         f"use `--after {last_task_id}` to get the next page.")
+
     def generate_latex_document(self, dfs: List[pd.DataFrame], output_dir: str):
         with open(self.params["latex_preamble"], "r", encoding="utf-8") as preamble_file:
             latex_preamble = preamble_file.read()
@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DSN = os.environ.get("TASHER_TEST_DSN")
+
+
+@pytest.fixture
+def database():
+    """Recreates the schema in the throwaway database given by the
+    TASHER_TEST_DSN environment variable and yields a connection to it."""
+    if DSN is None:
+        pytest.skip("TASHER_TEST_DSN is not set")
+    psycopg2 = pytest.importorskip("psycopg2")
+    with open(os.path.join(REPO_DIR, "TaskShuffler.sql"), "r", encoding="utf-8") as sql_file:
+        schema = sql_file.read()
+    conn = psycopg2.connect(DSN)
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS solutions, topic_task, subject_topic, "
+                    "tasks, topics, subjects CASCADE;")
+        cur.execute(schema)
+    conn.commit()
+    yield conn
+    conn.close()
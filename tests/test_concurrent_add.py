@@ -0,0 +1,116 @@
+"""Stress test of concurrent `add` runs.
+
+Checks that overlapping imports leave the DB and the solutions directory
+consistent. It doesn't check that the imports actually run in parallel
+rather than waiting for each other.
+
+Needs a throwaway PostgreSQL database given by the TASHER_TEST_DSN
+environment variable, e.g. "dbname=tasher_test user=postgres". All tables
+of the schema are dropped and recreated from TaskShuffler.sql (see the
+`database` fixture in conftest.py).
+"""
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+SAMPLE_SOLUTION = os.path.join(REPO_DIR, "input_files", "solutions", "sol_1.png")
+DSN = os.environ.get("TASHER_TEST_DSN")
+IMPORTERS = int(os.environ.get("TASHER_TEST_IMPORTERS", 8))
+TASKS_PER_IMPORTER = int(os.environ.get("TASHER_TEST_TASKS", 50))
+SOLUTION_PREFIX = "sol_"
+
+pytestmark = pytest.mark.skipif(DSN is None, reason="TASHER_TEST_DSN is not set")
+
+
+def write_config(tmp_path, work_dir) -> str:
+    """Writes config.ini to the `tmp_path` and returns the directory the
+    importers have to be run from (config is read from `../config.ini`)."""
+    run_dir = os.path.join(tmp_path, "run")
+    os.makedirs(run_dir)
+    with open(os.path.join(tmp_path, "config.ini"), "w", encoding="utf-8") as config_file:
+        config_file.write(
+            f"[postgresql]\n"
+            f"dsn = {DSN}\n"
+            f"\n"
+            f"[logging]\n"
+            f"level = WARNING\n"
+            f"log_path = {os.path.join(tmp_path, 'logs')}\n"
+            f"log_filename = tasher\n"
+            f"\n"
+            f"[tasher]\n"
+            f"solution_prefix = {SOLUTION_PREFIX}\n"
+            f"folder_prefix = TasherExport\n"
+            f"directory = {work_dir}\n"
+            f"latex_preamble = latex_preamble.tex\n"
+            f"latex_ending = latex_ending.tex\n"
+        )
+    return run_dir
+
+
+def make_input(tmp_path, importer: int):
+    """Creates a directory with solutions and the CSV with their details.
+    All importers share the subject and the topic, but not the tasks."""
+    input_dir = os.path.join(tmp_path, f"input_{importer}")
+    os.makedirs(input_dir)
+    details = ["solution;subject;topic;tex;difficulty;answer"]
+    for task in range(TASKS_PER_IMPORTER):
+        solution = f"sol_{importer}_{task}.png"
+        shutil.copy(SAMPLE_SOLUTION, os.path.join(input_dir, solution))
+        details.append(f"{solution};stress;concurrency;"
+                       f"\\int{{x^{{{importer}}} + {task} dx}};3;{task}")
+    details_csv = os.path.join(tmp_path, f"details_{importer}.csv")
+    with open(details_csv, "w", encoding="utf-8") as csv_file:
+        csv_file.write("\n".join(details) + "\n")
+    return input_dir, details_csv
+
+
+def run_importers(run_dir, inputs) -> None:
+    """Starts `add` for every input at once and waits for all of them."""
+    procs = [subprocess.Popen([sys.executable, os.path.join(SRC_DIR, "tasher.py"),
+                               "add", input_dir, "-d", details_csv],
+                              cwd=run_dir,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+             for input_dir, details_csv in inputs]
+    for proc in procs:
+        _, stderr = proc.communicate(timeout=600)
+        assert proc.returncode == 0, stderr.decode()
+
+
+def test_concurrent_add(tmp_path, database, monkeypatch):
+    monkeypatch.syspath_prepend(SRC_DIR)
+    from tasks import get_shard_name
+
+    work_dir = os.path.join(tmp_path, "work")
+    run_dir = write_config(tmp_path, work_dir)
+    inputs = [make_input(tmp_path, importer) for importer in range(IMPORTERS)]
+
+    # The second round replaces all solutions of the first one
+    run_importers(run_dir, inputs)
+    run_importers(run_dir, inputs)
+
+    with database.cursor() as cur:
+        cur.execute("SELECT solution_id, solution_filetype FROM solutions;")
+        solutions = cur.fetchall()
+    database.rollback()
+    assert len(solutions) == IMPORTERS * TASKS_PER_IMPORTER
+
+    # Every solution has exactly one file and there are no other files
+    solutions_dir = os.path.join(work_dir, ".tasher", "solutions")
+    files = sorted(os.path.join(root, name)
+                   for root, _, names in os.walk(solutions_dir)
+                   for name in names)
+    expected_files = sorted(
+        os.path.join(solutions_dir, get_shard_name(solution_id),
+                     f"{SOLUTION_PREFIX}{solution_id}{solution_filetype}")
+        for solution_id, solution_filetype in solutions)
+    assert files == expected_files
+
+    assert os.listdir(os.path.join(work_dir, ".tasher", "staging")) == []
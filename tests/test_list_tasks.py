@@ -0,0 +1,80 @@
+"""Listing tasks through a fresh connection.
+
+Needs a throwaway PostgreSQL database given by the TASHER_TEST_DSN
+environment variable (see the `database` fixture in conftest.py).
+"""
+import os
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("psycopg2")
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+DSN = os.environ.get("TASHER_TEST_DSN")
+NO_FILTERS = pd.Series({"subject": None, "topic": None})
+
+
+@pytest.fixture
+def tasher_db(database, monkeypatch):
+    """Yields a function connecting new TaskShufflerDB instances to the
+    test database and disconnects them afterwards."""
+    monkeypatch.syspath_prepend(SRC_DIR)
+    import db
+    monkeypatch.setattr(db, "config", lambda section: {"dsn": DSN})
+
+    connected = []
+
+    def connect():
+        tasher_db = db.TaskShufflerDB()
+        tasher_db.connect()
+        connected.append(tasher_db)
+        return tasher_db
+
+    yield connect
+    for tasher_db in connected:
+        tasher_db.disconnect()
+
+
+def insert_tasks(tasher_db, subject: str, topic: str, n_tasks: int) -> None:
+    for task in range(n_tasks):
+        tasher_db.insert_task(pd.DataFrame({
+            "subject": [subject] * 2,
+            "topic": [topic] * 2,
+            "tex": [f"{subject} {topic} {task}"] * 2,
+            "difficulty": [3] * 2,
+            "answer": [str(task)] * 2,
+            "solution_filetype": [".png", ".jpg"],
+        }))
+        tasher_db.commit()
+
+
+def test_get_tasks_after_connect(tasher_db):
+    insert_tasks(tasher_db(), "math", "integrals", 3)
+    insert_tasks(tasher_db(), "physics", "optics", 2)
+
+    # The first query of a fresh connection
+    task_set = tasher_db().get_tasks(NO_FILTERS)
+
+    assert len(task_set) == 5
+    assert list(task_set.links.subject.value_counts().sort_index()) == [3, 2]
+    display = task_set.to_display_frame(verbose=1)
+    assert len(display) == 5
+    assert all(len(ids.split(", ")) == 2 for ids in display.solution_ids)
+
+
+def test_get_tasks_filters_and_pages(tasher_db):
+    insert_tasks(tasher_db(), "math", "integrals", 3)
+    insert_tasks(tasher_db(), "physics", "optics", 2)
+    db = tasher_db()
+
+    math = db.get_tasks(pd.Series({"subject": ["math"], "topic": None}))
+    assert set(math.links.subject) == {"math"}
+    assert len(math) == 3
+
+    task_ids = list(db.get_tasks(NO_FILTERS).tasks.index)
+    first_page = db.get_tasks(NO_FILTERS, limit=2)
+    assert list(first_page.tasks.index) == task_ids[:2]
+    next_page = db.get_tasks(NO_FILTERS, limit=2, after_task_id=task_ids[1])
+    assert list(next_page.tasks.index) == task_ids[2:4]
+    assert len(db.get_tasks(NO_FILTERS, after_task_id=task_ids[-1])) == 0